@@ -1,5 +1,11 @@
+import os
+import numpy as np
 import pandas as pd
-import plotly.express as px
+from numba import njit
+import pyarrow as pa
+import pyarrow.parquet as pq
+import plotly.graph_objects as go
+import plotly.io.json
 import dash
 from dash import html, dcc
 from dash.dependencies import Input, Output, State
@@ -7,25 +13,144 @@ import dash_daq as daq
 import dash_bootstrap_components as dbc
 from dash import html as html_components  # Import html from dash
 
-# Load the dataset
-covid_data = pd.read_csv("data/covid_arg_0_1.csv")
+# Serialize figures and layout with orjson, which encodes NumPy arrays
+# natively instead of going through Python lists
+plotly.io.json.config.default_engine = "orjson"
 
-# Filter relevant data
-covid_filtered = covid_data[["gender", "age", "province"]].dropna()
+CSV_PATH = "data/covid_arg_0_1.csv"
+PARQUET_PATH = "data/covid.parquet"
+# Bump whenever the cached columns or their types change, files written
+# with another version are rebuilt from the CSV
+PARQUET_VERSION = b"2"
 
-# Convert 'age' column to integers
-covid_filtered["age"] = covid_filtered["age"].astype(int)
 
-# Prepare data for the Gapminder-like visualization
-gapminder_data = (
-    covid_filtered.groupby(["age", "province", "gender"])
-    .size()
-    .reset_index(name="cases")
+def _parquet_is_current():
+    if not os.path.exists(PARQUET_PATH):
+        return False
+    if os.path.exists(CSV_PATH) and os.path.getmtime(CSV_PATH) > os.path.getmtime(
+        PARQUET_PATH
+    ):
+        return False
+    metadata = pq.read_schema(PARQUET_PATH).metadata or {}
+    return metadata.get(b"ivi_version") == PARQUET_VERSION
+
+
+# Parse the CSV only when the cache is missing or stale and store the
+# cleaned columns as Parquet, other starts memory-map that file instead
+if not _parquet_is_current():
+    # Load only the needed columns with the multithreaded pyarrow parser.
+    # The low-cardinality string columns are read as categoricals so
+    # filtering and grouping work on small integer codes instead of strings
+    covid_filtered = pd.read_csv(
+        CSV_PATH,
+        usecols=["gender", "age", "province"],
+        dtype={"gender": "category", "province": "category"},
+        engine="pyarrow",
+    ).dropna()
+
+    # Convert 'age' column to the smallest integer type that holds it, one
+    # byte per row keeps the scans cache-friendly
+    covid_filtered = covid_filtered[covid_filtered["age"].between(0, 255)].astype(
+        {"age": "uint8"}
+    )
+
+    table = pa.Table.from_pandas(covid_filtered, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, b"ivi_version": PARQUET_VERSION}
+    )
+
+    # Write to a temporary file and swap it in, so an app starting at the
+    # same time never memory-maps a half-written file
+    tmp_path = "%s.%d.tmp" % (PARQUET_PATH, os.getpid())
+    pq.write_table(table, tmp_path, compression="zstd", use_dictionary=True)
+    os.replace(tmp_path, PARQUET_PATH)
+
+# Dictionary-encoded columns come back as pandas categoricals
+covid_filtered = pq.read_table(PARQUET_PATH, memory_map=True).to_pandas()
+
+# Values the layout needs, computed once instead of rescanning the columns
+AGE_MIN = int(covid_filtered["age"].min())
+AGE_MAX = int(covid_filtered["age"].max())
+AGE_MARKS = {i: str(i) for i in range(AGE_MIN, AGE_MAX + 1, 10)}
+GENDERS = covid_filtered["gender"].unique().tolist()
+
+gender_categories = covid_filtered["gender"].cat.categories
+province_categories = covid_filtered["province"].cat.categories
+
+
+@njit(cache=True)
+def _count_cases(gender_codes, ages, province_codes, out):
+    # One compiled pass over the raw rows, no Python objects in the loop
+    for i in range(len(ages)):
+        out[gender_codes[i], ages[i], province_codes[i]] += 1
+
+
+# Pre-aggregate the cases into a dense counts[gender, age, province]
+# tensor once at startup, the callbacks only slice and sum this tensor
+counts = np.zeros(
+    (
+        len(gender_categories),
+        AGE_MAX + 1,
+        len(province_categories),
+    ),
+    dtype=np.int32,
 )
+_count_cases(
+    np.ascontiguousarray(covid_filtered["gender"].cat.codes.to_numpy()),
+    np.ascontiguousarray(covid_filtered["age"].to_numpy()),
+    np.ascontiguousarray(covid_filtered["province"].cat.codes.to_numpy()),
+    counts,
+)
+
+# Non-empty cells of the counts tensor, shipped to the browser once so the
+# graphs are filtered and aggregated there without a server round trip
+gender_idx, age_idx, province_idx = np.nonzero(counts)
+case_table = {
+    "genders": gender_categories.tolist(),
+    "provinces": province_categories.tolist(),
+    "gender": gender_idx.tolist(),
+    "age": age_idx.tolist(),
+    "province": province_idx.tolist(),
+    "cases": counts[gender_idx, age_idx, province_idx].tolist(),
+}
 
 # Create Dash application
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
+# Both figures are built once, the callback only replaces their trace data
+fig1_template = go.Figure(
+    go.Bar(x=[], y=[], hovertemplate="province=%{x}<br>cases=%{y}<extra></extra>"),
+    layout=dict(
+        title="COVID-19 Cases by Region",
+        xaxis_title="province",
+        yaxis_title="cases",
+    ),
+)
+# One WebGL scatter trace per gender category, like render_mode="webgl" in lo1.py
+fig2_template = go.Figure(
+    [
+        go.Scattergl(
+            x=[],
+            y=[],
+            mode="markers",
+            name=gender,
+            marker=dict(size=[], sizemode="area", sizeref=1),
+            hovertemplate=(
+                "gender=" + gender + "<br>age=%{x}<br>province=%{y}"
+                "<br>cases=%{marker.size}<extra></extra>"
+            ),
+        )
+        for gender in gender_categories
+    ],
+    layout=dict(
+        title="Age-Region Frequency Visualization",
+        xaxis_title="age",
+        yaxis_title="province",
+        legend_title_text="gender",
+        legend_itemsizing="constant",
+    ),
+)
+
 navbar = dbc.Navbar(
     dbc.Container(
         [
@@ -70,6 +195,9 @@ app.layout = html.Div(
         navbar,
         html_components.Div([  # Use html_components.Div for the JavaScript code
             html.Script(javascript),  # Include the JavaScript code using html.Script
+            dcc.Store(id="case-table", data=case_table),
+            # Filter the graphs on this page were last drawn for, reset on reload
+            dcc.Store(id="graph-filter"),
             html.H1("COVID-19 Visualizations for Argentina", style={"textAlign": "center"}),
             html.Div(
                 [
@@ -77,7 +205,11 @@ app.layout = html.Div(
                     html.Div(
                         [
                             html.H2("COVID-19 Cases by Region"),
-                            dcc.Graph(id="region-cases-graph", style={"height": "500px"}),
+                            dcc.Graph(
+                                id="region-cases-graph",
+                                figure=fig1_template,
+                                style={"height": "500px"},
+                            ),
                         ],
                         className="six columns",
                         id="region-cases-graph-section",  # Add this ID
@@ -86,7 +218,11 @@ app.layout = html.Div(
                     html.Div(
                         [
                             html.H2("Age-Region Frequency Visualization"),
-                            dcc.Graph(id="age-region-graph", style={"height": "500px"}),
+                            dcc.Graph(
+                                id="age-region-graph",
+                                figure=fig2_template,
+                                style={"height": "500px"},
+                            ),
                         ],
                         className="six columns",
                         id="age-region-graph-section",  # Add this ID
@@ -101,9 +237,9 @@ app.layout = html.Div(
                         id="gender-dropdown",
                         options=[
                             {"label": i, "value": i}
-                            for i in covid_filtered["gender"].unique()
+                            for i in GENDERS
                         ],
-                        value=covid_filtered["gender"].unique().tolist(),
+                        value=GENDERS,
                         multi=True,
                     ),
                 ]
@@ -114,18 +250,13 @@ app.layout = html.Div(
                     html.Label("Select Age Range:"),
                     dcc.RangeSlider(
                         id="age-range-slider",
-                        min=covid_filtered["age"].min(),
-                        max=covid_filtered["age"].max(),
+                        min=AGE_MIN,
+                        max=AGE_MAX,
                         step=1,
-                        value=[covid_filtered["age"].min(), covid_filtered["age"].max()],
-                        marks={
-                            i: str(i)
-                            for i in range(
-                                covid_filtered["age"].min(),
-                                covid_filtered["age"].max() + 1,
-                                10,
-                            )
-                        },
+                        value=[AGE_MIN, AGE_MAX],
+                        marks=AGE_MARKS,
+                        # Only filter once the handle is released, not on every drag step
+                        updatemode="mouseup",
                     ),
                 ],
                 style={"padding": "20px 0 20px 0"},
@@ -134,52 +265,66 @@ app.layout = html.Div(
     ]
 )
 
-# Callback for updating both graphs
-@app.callback(
-    [Output("region-cases-graph", "figure"), Output("age-region-graph", "figure")],
-    [Input("gender-dropdown", "value"), Input("age-range-slider", "value")],
-)
-def update_graphs(selected_genders, age_range):
-    # Filter data based on gender and age range
-    filtered_df = covid_filtered[
-        (covid_filtered["gender"].isin(selected_genders))
-        & (covid_filtered["age"] >= age_range[0])
-        & (covid_filtered["age"] <= age_range[1])
-    ]
+# Filter and aggregate the case table in the browser. Trace i of the
+# age-region graph belongs to gender category i, marker areas are scaled
+# like px.scatter with its default size_max=20
+update_graphs = """
+function(genders, ageRange, table, fig1, fig2, lastFilter) {
+    // Nothing to redraw if the filter did not actually change
+    const graphFilter = [[...genders].sort(), ageRange[0], ageRange[1]];
+    if (JSON.stringify(graphFilter) === JSON.stringify(lastFilter)) {
+        throw window.dash_clientside.PreventUpdate;
+    }
 
-    # Update region-cases graph
-    region_cases_df = (
-        filtered_df.groupby("province")
-        .size()
-        .reset_index(name="cases")
-    )
-    region_cases_df = region_cases_df.sort_values(
-        "cases", ascending=False
-    )  # Sort in descending order
-    fig1 = px.bar(
-        region_cases_df,
-        x="province",
-        y="cases",
-        title="COVID-19 Cases by Region",
-    )
+    const lo = ageRange[0], hi = ageRange[1];
+    const selected = table.genders.map((g) => genders.includes(g));
+    const regionCases = new Array(table.provinces.length).fill(0);
+    const traces = fig2.data.map((t) => ({
+        ...t, x: [], y: [], marker: {...t.marker, size: []},
+    }));
+    let maxCases = 1;
+    for (let i = 0; i < table.cases.length; i++) {
+        const g = table.gender[i], age = table.age[i];
+        if (!selected[g] || age < lo || age > hi) continue;
+        const p = table.province[i], cases = table.cases[i];
+        regionCases[p] += cases;
+        traces[g].x.push(age);
+        traces[g].y.push(table.provinces[p]);
+        traces[g].marker.size.push(cases);
+        maxCases = Math.max(maxCases, cases);
+    }
+    traces.forEach((t) => { t.marker.sizeref = maxCases / 400; });
 
-    # Update age-region graph
-    age_region_df = (
-        filtered_df.groupby(["age", "province", "gender"])
-        .size()
-        .reset_index(name="cases")
-    )
-    fig2 = px.scatter(
-        age_region_df,
-        x="age",
-        y="province",
-        size="cases",
-        color="gender",
-        title="Age-Region Frequency Visualization",
-        hover_data=["cases"],
-    )
+    // Regions sorted in descending order
+    const order = regionCases
+        .map((_, p) => p)
+        .filter((p) => regionCases[p] > 0)
+        .sort((a, b) => regionCases[b] - regionCases[a]);
+    const bar = {
+        ...fig1.data[0],
+        x: order.map((p) => table.provinces[p]),
+        y: order.map((p) => regionCases[p]),
+    };
+    return [{...fig1, data: [bar]}, {...fig2, data: traces}, graphFilter];
+}
+"""
 
-    return fig1, fig2
+# Callback for updating both graphs, runs client-side
+app.clientside_callback(
+    update_graphs,
+    [
+        Output("region-cases-graph", "figure"),
+        Output("age-region-graph", "figure"),
+        Output("graph-filter", "data"),
+    ],
+    [Input("gender-dropdown", "value"), Input("age-range-slider", "value")],
+    [
+        State("case-table", "data"),
+        State("region-cases-graph", "figure"),
+        State("age-region-graph", "figure"),
+        State("graph-filter", "data"),
+    ],
+)
 
 # Run the app
 if __name__ == "__main__":
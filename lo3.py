@@ -1,31 +1,227 @@
 import time
+import os
+import numpy as np
 import pandas as pd
-import plotly.express as px
+from numba import njit
+import pyarrow as pa
+import pyarrow.parquet as pq
+import plotly.graph_objects as go
+import plotly.io.json
 import dash
-from dash import html, dcc
+from dash import html, dcc, Patch
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_daq as daq
 import dash_bootstrap_components as dbc
+from flask_caching import Cache
 
-# Load the dataset
-covid_data = pd.read_csv("data/covid_arg_0_1.csv")
+# Serialize figures and layout with orjson, which encodes NumPy arrays
+# natively instead of going through Python lists
+plotly.io.json.config.default_engine = "orjson"
 
-# Filter relevant data
-covid_filtered = covid_data[["gender", "age", "province"]].dropna()
+CSV_PATH = "data/covid_arg_0_1.csv"
+PARQUET_PATH = "data/covid.parquet"
+# Bump whenever the cached columns or their types change, files written
+# with another version are rebuilt from the CSV
+PARQUET_VERSION = b"2"
 
-# Convert 'age' column to integers
-covid_filtered["age"] = covid_filtered["age"].astype(int)
 
-# Prepare data for the Gapminder-like visualization
-gapminder_data = (
-    covid_filtered.groupby(["age", "province", "gender"])
-    .size()
-    .reset_index(name="cases")
+def _parquet_is_current():
+    if not os.path.exists(PARQUET_PATH):
+        return False
+    if os.path.exists(CSV_PATH) and os.path.getmtime(CSV_PATH) > os.path.getmtime(
+        PARQUET_PATH
+    ):
+        return False
+    metadata = pq.read_schema(PARQUET_PATH).metadata or {}
+    return metadata.get(b"ivi_version") == PARQUET_VERSION
+
+
+# Parse the CSV only when the cache is missing or stale and store the
+# cleaned columns as Parquet, other starts memory-map that file instead
+if not _parquet_is_current():
+    # Load only the needed columns with the multithreaded pyarrow parser.
+    # The low-cardinality string columns are read as categoricals so
+    # filtering and grouping work on small integer codes instead of strings
+    covid_filtered = pd.read_csv(
+        CSV_PATH,
+        usecols=["gender", "age", "province"],
+        dtype={"gender": "category", "province": "category"},
+        engine="pyarrow",
+    ).dropna()
+
+    # Convert 'age' column to the smallest integer type that holds it, one
+    # byte per row keeps the scans cache-friendly
+    covid_filtered = covid_filtered[covid_filtered["age"].between(0, 255)].astype(
+        {"age": "uint8"}
+    )
+
+    table = pa.Table.from_pandas(covid_filtered, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, b"ivi_version": PARQUET_VERSION}
+    )
+
+    # Write to a temporary file and swap it in, so an app starting at the
+    # same time never memory-maps a half-written file
+    tmp_path = "%s.%d.tmp" % (PARQUET_PATH, os.getpid())
+    pq.write_table(table, tmp_path, compression="zstd", use_dictionary=True)
+    os.replace(tmp_path, PARQUET_PATH)
+
+# Dictionary-encoded columns come back as pandas categoricals
+covid_filtered = pq.read_table(PARQUET_PATH, memory_map=True).to_pandas()
+
+# Values the layout needs, computed once instead of rescanning the columns
+AGE_MIN = int(covid_filtered["age"].min())
+AGE_MAX = int(covid_filtered["age"].max())
+AGE_MARKS = {i: str(i) for i in range(AGE_MIN, AGE_MAX + 1, 10)}
+GENDERS = covid_filtered["gender"].unique().tolist()
+
+gender_categories = covid_filtered["gender"].cat.categories
+province_categories = covid_filtered["province"].cat.categories
+gender_index = {gender: i for i, gender in enumerate(gender_categories)}
+
+
+@njit(cache=True)
+def _count_cases(gender_codes, ages, province_codes, out):
+    # One compiled pass over the raw rows, no Python objects in the loop
+    for i in range(len(ages)):
+        out[gender_codes[i], ages[i], province_codes[i]] += 1
+
+
+# Pre-aggregate the cases into a dense counts[gender, age, province]
+# tensor once at startup, the callbacks only slice and sum this tensor
+counts = np.zeros(
+    (
+        len(gender_categories),
+        AGE_MAX + 1,
+        len(province_categories),
+    ),
+    dtype=np.int32,
+)
+_count_cases(
+    np.ascontiguousarray(covid_filtered["gender"].cat.codes.to_numpy()),
+    np.ascontiguousarray(covid_filtered["age"].to_numpy()),
+    np.ascontiguousarray(covid_filtered["province"].cat.codes.to_numpy()),
+    counts,
 )
 
 # Create Dash application with Bootstrap components for better mobile responsiveness
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
+# The figures only depend on the selected genders and age range, memoize
+# them in process memory so repeated selections skip the computation. The
+# cache dies with the process, so it never outlives the code or the data
+cache = Cache(app.server, config={"CACHE_TYPE": "SimpleCache"})
+
+# Compute the trace data of both figures for one gender selection and age range
+@cache.memoize(timeout=3600)
+def _compute(genders, age_lo, age_hi):
+    # Slice the tensor to the age range and zero out unselected genders,
+    # their traces stay in the figure but without points
+    gender_mask = np.zeros(len(gender_categories), dtype=bool)
+    gender_mask[[gender_index[g] for g in genders if g in gender_index]] = True
+    selected = np.where(
+        gender_mask[:, None, None], counts[:, age_lo : age_hi + 1, :], 0
+    )
+
+    # Scan the slice once for its non-empty cells, the age-region graph
+    # plots them as they are and the region totals are summed from them
+    gender_idx, age_idx, province_idx = np.nonzero(selected)
+    cases = selected[gender_idx, age_idx, province_idx]
+
+    # Region-cases graph, sorted in descending order
+    region_cases = np.bincount(
+        province_idx, weights=cases, minlength=len(province_categories)
+    ).astype(np.int64)
+    order = np.argsort(-region_cases, kind="stable")
+    order = order[region_cases[order] > 0]
+    region = (province_categories[order].tolist(), region_cases[order])
+
+    # Age-region graph, one trace per gender. The cells come out ordered by
+    # gender, so each trace is a contiguous run of them. Numeric columns stay
+    # NumPy arrays for orjson's fast path
+    bounds = np.searchsorted(gender_idx, np.arange(len(gender_categories) + 1))
+    age_region = [
+        (
+            age_idx[start:stop] + age_lo,
+            province_categories[province_idx[start:stop]].tolist(),
+            cases[start:stop],
+        )
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+    # Scale the marker areas like px.scatter with its default size_max=20
+    sizeref = float(max(cases.max(initial=0), 1)) / 20**2
+
+    return region, age_region, sizeref
+
+
+def _fill_figures(fig1, fig2, trace_data):
+    # Write _compute's trace data into both figures, either the pre-built
+    # go.Figures or the callback's Patches
+    region, age_region, sizeref = trace_data
+
+    fig1["data"][0]["x"] = region[0]
+    fig1["data"][0]["y"] = region[1]
+
+    for i, (ages, provinces, cases) in enumerate(age_region):
+        fig2["data"][i]["x"] = ages
+        fig2["data"][i]["y"] = provinces
+        fig2["data"][i]["marker"]["size"] = cases
+        fig2["data"][i]["marker"]["sizeref"] = sizeref
+
+
+# Both figures are built once, the callback only patches their trace data
+fig1_template = go.Figure(
+    go.Bar(x=[], y=[], hovertemplate="province=%{x}<br>cases=%{y}<extra></extra>"),
+    layout=dict(
+        xaxis_title="province",
+        yaxis_title="cases",
+        # Implement animated transitions
+        transition_duration=500,
+    ),
+)
+
+# Legend labels for the 'gender' variable
+GENDER_LABELS = {"F": "Female", "M": "Male", "NR": "Unknown"}
+
+# One WebGL scatter trace per gender category, like render_mode="webgl" in lo1.py
+fig2_template = go.Figure(
+    [
+        go.Scattergl(
+            x=[],
+            y=[],
+            mode="markers",
+            name=GENDER_LABELS.get(gender, gender),
+            marker=dict(size=[], sizemode="area", sizeref=1),
+            hovertemplate=(
+                "gender=" + gender + "<br>age=%{x}<br>province=%{y}"
+                "<br>cases=%{marker.size}<extra></extra>"
+            ),
+        )
+        for gender in gender_categories
+    ],
+    layout=dict(
+        xaxis_title="age",
+        yaxis_title="province",
+        legend_title_text="gender",
+        legend_itemsizing="constant",
+        # Implement animated transitions
+        transition_duration=500,
+    ),
+)
+
+# Figures for the default filter are built at import, so the first page
+# load needs no callback. They bypass the memoize cache, so a cache entry
+# can never keep the app from starting
+DEFAULT_FILTER = [sorted(GENDERS), AGE_MIN, AGE_MAX]
+fig1_default = go.Figure(fig1_template)
+fig2_default = go.Figure(fig2_template)
+_fill_figures(
+    fig1_default,
+    fig2_default,
+    _compute.uncached(tuple(DEFAULT_FILTER[0]), AGE_MIN, AGE_MAX),
+)
+
 
 # Function to create tooltip
 def create_tooltip(id, text):
@@ -91,7 +287,9 @@ app.layout = dbc.Container(
                             id="loading-region",
                             type="default",
                             children=dcc.Graph(
-                                id="region-cases-graph", style={"height": "500px"}
+                                id="region-cases-graph",
+                                figure=fig1_default,
+                                style={"height": "500px"},
                             ),
                         ),
                         create_tooltip(
@@ -108,7 +306,9 @@ app.layout = dbc.Container(
                             id="loading-age-region",
                             type="default",
                             children=dcc.Graph(
-                                id="age-region-graph", style={"height": "500px"}
+                                id="age-region-graph",
+                                figure=fig2_default,
+                                style={"height": "500px"},
                             ),
                         ),
                         create_tooltip(
@@ -129,9 +329,9 @@ app.layout = dbc.Container(
                             id="gender-dropdown",
                             options=[
                                 {"label": i, "value": i}
-                                for i in covid_filtered["gender"].unique()
+                                for i in GENDERS
                             ],
-                            value=covid_filtered["gender"].unique().tolist(),
+                            value=GENDERS,
                             multi=True,
                         ),
                         create_tooltip("gender-label", "Filter data by gender."),
@@ -146,21 +346,13 @@ app.layout = dbc.Container(
                         html.Label("Select Age Range:", id="age-range-label"),
                         dcc.RangeSlider(
                             id="age-range-slider",
-                            min=covid_filtered["age"].min(),
-                            max=covid_filtered["age"].max(),
+                            min=AGE_MIN,
+                            max=AGE_MAX,
                             step=1,
-                            value=[
-                                covid_filtered["age"].min(),
-                                covid_filtered["age"].max(),
-                            ],
-                            marks={
-                                i: str(i)
-                                for i in range(
-                                    covid_filtered["age"].min(),
-                                    covid_filtered["age"].max() + 1,
-                                    10,
-                                )
-                            },
+                            value=[AGE_MIN, AGE_MAX],
+                            marks=AGE_MARKS,
+                            # Only filter once the handle is released, not on every drag step
+                            updatemode="mouseup",
                         ),
                         create_tooltip(
                             "age-range-label",
@@ -173,6 +365,8 @@ app.layout = dbc.Container(
         ),
         help_legend,
         reference_block,
+        # Filter the graphs on this page were last drawn for, reset on reload
+        dcc.Store(id="graph-filter", data=DEFAULT_FILTER),
     ],
     fluid=True,
 )
@@ -180,57 +374,32 @@ app.layout = dbc.Container(
 
 # Callback for updating both graphs
 @app.callback(
-    [Output("region-cases-graph", "figure"), Output("age-region-graph", "figure")],
+    [
+        Output("region-cases-graph", "figure"),
+        Output("age-region-graph", "figure"),
+        Output("graph-filter", "data"),
+    ],
     [Input("gender-dropdown", "value"), Input("age-range-slider", "value")],
+    [State("graph-filter", "data")],
+    prevent_initial_call=True,
 )
-def update_graphs(selected_genders, age_range):
-    # Filter data based on gender and age range
-    filtered_df = covid_filtered[
-        (covid_filtered["gender"].isin(selected_genders))
-        & (covid_filtered["age"] >= age_range[0])
-        & (covid_filtered["age"] <= age_range[1])
-    ]
+def update_graphs(selected_genders, age_range, last_filter):
+    # Sort the selection so equal filters share a cache key, nothing to
+    # redraw if the filter did not actually change
+    graph_filter = [sorted(selected_genders), age_range[0], age_range[1]]
+    if graph_filter == last_filter:
+        raise PreventUpdate
 
-    # Update region-cases graph
-    region_cases_df = filtered_df.groupby("province").size().reset_index(name="cases")
-    region_cases_df = region_cases_df.sort_values(
-        "cases", ascending=False
-    )  # Sort in descending order
-    fig1 = px.bar(region_cases_df, x="province", y="cases")
-
-    # Update age-region graph
-    age_region_df = (
-        filtered_df.groupby(["age", "province", "gender"])
-        .size()
-        .reset_index(name="cases")
-    )
-    fig2 = px.scatter(
-        age_region_df,
-        x="age",
-        y="province",
-        size="cases",
-        color="gender",
-        hover_data=["cases"],
-    )
-
-    # Update the legend labels for the 'gender' variable
-    fig2.update_traces(
-        name="Female",
-        selector=dict(name="F"),
-    )
-    fig2.update_traces(
-        name="Male",
-        selector=dict(name="M"),
-    )
-    fig2.update_traces(
-        name="Unknown",
-        selector=dict(name="NR"),
+    # Only send the changed trace data, the rest of the figures stays as is
+    fig1 = Patch()
+    fig2 = Patch()
+    _fill_figures(
+        fig1,
+        fig2,
+        _compute(tuple(graph_filter[0]), graph_filter[1], graph_filter[2]),
     )
-    # Implement animated transitions
-    fig1.update_layout(transition_duration=500)
-    fig2.update_layout(transition_duration=500)
 
-    return fig1, fig2
+    return fig1, fig2, graph_filter
 
 
 # Run the app